@@ -0,0 +1,36 @@
+"""
+Общий загрузчик credentials для скриптов PowerDemon.AI.
+Читает businesses/{name}/.credentials (строки KEY=VALUE, # — комментарий).
+"""
+
+import os
+import re
+from functools import lru_cache
+
+# Строка, а не Path: путь собирается одним os.path.join на вызов
+BUSINESSES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "businesses")
+
+# KEY=VALUE за один проход regex; пробелы вокруг ключа и значения отбрасываются
+_CRED_RE = re.compile(r"(?m)^(?!#)[ \t]*([^=\s][^=\r\n]*?)[ \t]*=[ \t]*(.*?)[ \t\r]*$")
+
+
+@lru_cache(maxsize=128)
+def _load_credentials_cached(path: str, mtime_ns: int) -> tuple:
+    """Распарсить .credentials; кэш по (путь, mtime), сбрасывается при правке файла.
+
+    Возвращает неизменяемые пары (ключ, значение): правка результата
+    вызывающим кодом не испортит кэш.
+    """
+    with open(path, "rb") as f:
+        text = f.read().decode("utf-8")
+    return tuple(_CRED_RE.findall(text))
+
+
+def load_credentials(business: str) -> dict:
+    """Загрузить credentials из businesses/{name}/.credentials"""
+    path = os.path.join(BUSINESSES_DIR, business, ".credentials")
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    return dict(_load_credentials_cached(path, mtime_ns))
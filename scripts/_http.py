@@ -0,0 +1,91 @@
+"""
+Общие HTTP-настройки для скриптов PowerDemon.AI.
+Keep-alive сессия с пулом соединений и повтором на временных ошибках сервера,
+быстрый JSON через orjson и кэш GET-ответов через requests-cache (если установлены).
+"""
+
+import os
+import json
+import sqlite3
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен — без него работает stdlib json
+    orjson = None
+
+try:
+    import requests_cache
+except ImportError:  # requests-cache необязателен — без него обычная сессия
+    requests_cache = None
+
+# Повтор на временных ошибках сервера; Retry неизменяем, объект общий для всех сессий
+_RETRY = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+
+# Для GET-запросов к API с лимитами: ждём и на 429 (с учётом Retry-After), и на любой 5xx;
+# после последней попытки отдаём ответ как есть — ошибку формирует вызывающий код
+_RETRY_RATE_LIMITED = Retry(
+    total=5,
+    backoff_factor=0.8,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["GET"]),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+
+def make_session(headers: dict = None, retry_post: bool = False) -> requests.Session:
+    """Сессия с пулом соединений и повтором при 502/503/504.
+
+    POST повторяется только при retry_post=True — для идемпотентных запросов
+    (например, отчётов); создание кампаний и объявлений повторно не отправляем.
+    """
+    retry = _RETRY
+    if retry_post:
+        retry = retry.new(allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"})
+    return _setup_session(requests.Session(), retry, headers)
+
+
+def make_cached_session(cache_path: str, expire_after: int, headers: dict = None,
+                        rate_limited: bool = False) -> requests.Session:
+    """Сессия с кэшем GET-ответов в SQLite (cache_path, TTL в секундах).
+
+    rate_limited=True — повтор GET ещё и на 429/500 с экспоненциальной паузой.
+    Без requests-cache или если каталог кэша недоступен для записи (например,
+    под cron) возвращает обычную сессию с теми же повторами.
+    """
+    retry = _RETRY_RATE_LIMITED if rate_limited else _RETRY
+    if requests_cache is None:
+        return _setup_session(requests.Session(), retry, headers)
+    cache_path = os.path.expanduser(cache_path)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        session = requests_cache.CachedSession(cache_path, expire_after=expire_after, allowable_methods=("GET",))
+    except (OSError, sqlite3.Error):
+        session = requests.Session()
+    return _setup_session(session, retry, headers)
+
+
+def _setup_session(session: requests.Session, retry: Retry, headers: dict = None) -> requests.Session:
+    """Пул соединений с повторами и общие заголовки"""
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def json_dumps(obj) -> bytes:
+    """Тело JSON-запроса в UTF-8 (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def json_loads(data: bytes):
+    """Разобрать JSON-ответ (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
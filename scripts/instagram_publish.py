@@ -11,72 +11,186 @@ Instagram Publisher for PowerDemon.AI
 """
 
 import os
+import re
 import sys
 import json
+import time
+import random
 import argparse
+from collections import Counter
+from dataclasses import dataclass
 from pathlib import Path
 from datetime import datetime
 
+from _credentials import load_credentials
+
 # === Конфигурация ===
 
 BUSINESSES_DIR = Path(__file__).parent.parent / "businesses"
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp"}
+VIDEO_EXTENSIONS = {".mp4", ".mov"}
+_DRAFT_NAME_RE = re.compile(r"\d{4}-(\d{2}-\d{2})_[\w.-]+")
+# Строка таблицы _queue.md: | # | Дата | Канал | Контент | Статус |
+_QUEUE_ROW_RE = re.compile(r"^\|([^|\n]*)\|([^|\n]*)\|([^|\n]*)\|([^|\n]*)\|([^|\n]*)\|", re.M)
+PENDING_STATUSES = {"⏳ На одобрении", "✅ Одобрен"}
+# Лимит публикаций: 150 операций за 90 минут, не больше 3 подряд
+PUBLISH_RATE_PER_MIN = 150 / 90
+PUBLISH_BURST = 3
+PUBLISH_RETRIES = 3
+RATE_STATE_FILE = ".instagram_rate.json"  # состояние лимитера в drafts/
+# Исключения instagrapi, которыми Instagram просит подождать
+RATE_LIMIT_ERRORS = {"PleaseWaitFewMinutes", "RateLimitError", "ClientThrottledError"}
+_CAPTION_HEADER_RE = re.compile(r"\A(?:#[^\n]*(?:\n|\Z)|[^\S\n]*\n)+")
+
+def read_utf8(path) -> str:
+    """Прочитать файл целиком: одно чтение байтов и одно декодирование UTF-8"""
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8")
 
-def load_credentials(business: str) -> dict:
-    """Загрузить credentials из businesses/{name}/.credentials"""
-    cred_file = BUSINESSES_DIR / business / ".credentials"
-    env = {}
-    if cred_file.exists():
-        for line in cred_file.read_text().splitlines():
-            if "=" in line and not line.startswith("#"):
-                key, value = line.split("=", 1)
-                env[key.strip()] = value.strip()
-    return env
+def write_utf8(path, text: str):
+    """Записать текст в UTF-8 без текстового слоя и перевода строк"""
+    with open(path, "wb") as f:
+        f.write(text.encode("utf-8"))
 
 def get_draft_path(business: str, draft: str) -> Path:
     return BUSINESSES_DIR / business / "drafts" / "instagram" / draft
 
-def read_caption(draft_path: Path) -> str:
-    """Прочитать текст подписи"""
-    caption_file = draft_path / "caption.md"
-    if not caption_file.exists():
-        raise FileNotFoundError(f"Нет caption.md в {draft_path}")
-    
-    text = caption_file.read_text()
-    # Убираем заголовок markdown
-    lines = text.split("\n")
-    content_lines = []
-    skip_header = True
-    for line in lines:
-        if skip_header and (line.startswith("#") or line.strip() == "" or line.startswith("## Подпись")):
-            if line.startswith("## Подпись"):
-                skip_header = False
-            continue
-        skip_header = False
-        content_lines.append(line)
-    
-    return "\n".join(content_lines).strip()
-
-def get_images(draft_path: Path) -> list:
-    """Найти все изображения в черновике"""
-    extensions = {".png", ".jpg", ".jpeg", ".webp"}
-    images = []
-    for f in sorted(draft_path.iterdir()):
-        if f.suffix.lower() in extensions:
-            images.append(f)
-    return images
-
-def read_meta(draft_path: Path) -> dict:
-    """Прочитать мета-данные поста"""
-    meta_file = draft_path / "meta.md"
+def list_drafts(business: str) -> dict:
+    """Папки черновиков Instagram: имя → путь (одно чтение каталога)"""
+    drafts_dir = BUSINESSES_DIR / business / "drafts" / "instagram"
+    if not drafts_dir.exists():
+        return {}
+    with os.scandir(drafts_dir) as it:
+        return {e.name: Path(e.path) for e in it if e.is_dir() and not e.name.startswith("_")}
+
+def group_drafts_by_date(drafts: dict) -> dict:
+    """Сгруппировать имена черновиков по дате MM-DD из префикса YYYY-MM-DD_"""
+    drafts_by_date = {}
+    for name in drafts:
+        m = _DRAFT_NAME_RE.fullmatch(name)
+        if m:
+            drafts_by_date.setdefault(m.group(1), []).append(name)
+    return drafts_by_date
+
+def match_queue_row(row: re.Match, drafts: dict, drafts_by_date: dict, rows_per_date: Counter):
+    """Найти папку черновика для строки _queue.md: по имени папки, иначе по дате"""
+    for m in _DRAFT_NAME_RE.finditer(row.group(0)):
+        if m.group(0) in drafts:
+            return m.group(0)
+    # Колонка «Дата» в формате MM-DD — годится, только если за эту дату
+    # в очереди одна строка Instagram и в drafts/ одна папка
+    date = row.group(2).strip()
+    candidates = drafts_by_date.get(date, [])
+    if len(candidates) == 1 and rows_per_date[date] == 1:
+        return candidates[0]
+    return None
+
+def parse_queue(text: str, drafts: dict) -> list:
+    """Строки Instagram из _queue.md за один проход: [(имя черновика или None, match)]"""
+    rows = [row for row in _QUEUE_ROW_RE.finditer(text) if "Instagram" in row.group(3)]
+    rows_per_date = Counter(row.group(2).strip() for row in rows)
+    drafts_by_date = group_drafts_by_date(drafts)
+    return [(match_queue_row(row, drafts, drafts_by_date, rows_per_date), row) for row in rows]
+
+def parse_caption(text: str) -> str:
+    """Выделить текст подписи из caption.md"""
+    # Всё после строки «## Подпись» — это и есть подпись
+    _, sep, body = text.partition("## Подпись")
+    if sep:
+        return body.partition("\n")[2].strip()
+    # Иначе убираем ведущие заголовки markdown и пустые строки
+    return _CAPTION_HEADER_RE.sub("", text).strip()
+
+def parse_meta(text: str) -> dict:
+    """Выделить мета-данные поста из meta.md"""
     meta = {"format": "photo"}
-    if meta_file.exists():
-        text = meta_file.read_text()
-        if "Карусель" in text or "карусель" in text:
-            meta["format"] = "album"
-        elif "Reels" in text or "reels" in text:
-            meta["format"] = "reels"
+    if "Карусель" in text or "карусель" in text:
+        meta["format"] = "album"
+    elif "Reels" in text or "reels" in text:
+        meta["format"] = "reels"
     return meta
 
+@dataclass(slots=True)
+class DraftBundle:
+    """Содержимое папки черновика"""
+    images: list
+    videos: list
+    caption: str
+    meta: dict
+
+def inspect_draft(draft_path: Path) -> DraftBundle:
+    """Разобрать черновик за один проход по папке: медиа, подпись, мета"""
+    images, videos = [], []
+    caption_file = meta_file = None
+    with os.scandir(draft_path) as it:
+        for entry in it:
+            if entry.name == "caption.md":
+                caption_file = entry.path
+                continue
+            if entry.name == "meta.md":
+                meta_file = entry.path
+                continue
+            ext = os.path.splitext(entry.name)[1].lower()
+            if ext in IMAGE_EXTENSIONS and entry.is_file():
+                images.append(entry)
+            elif ext in VIDEO_EXTENSIONS and entry.is_file():
+                videos.append(entry)
+    if caption_file is None:
+        raise FileNotFoundError(f"Нет caption.md в {draft_path}")
+
+    images.sort(key=lambda e: e.name)
+    videos.sort(key=lambda e: e.name)
+    return DraftBundle(
+        images=[Path(e.path) for e in images],
+        videos=[Path(e.path) for e in videos],
+        caption=parse_caption(read_utf8(caption_file)),
+        meta=parse_meta(read_utf8(meta_file)) if meta_file else {"format": "photo"},
+    )
+
+class TokenBucket:
+    """Лимитер публикаций: rate_per_min токенов в минуту, не больше burst подряд.
+
+    Состояние лежит в JSON-файле, чтобы лимит переживал перезапуски cron;
+    поэтому время берём из time.time(), а не monotonic.
+    """
+
+    def __init__(self, rate_per_min: float, burst: int, state_file: Path = None):
+        self.rate = rate_per_min / 60
+        self.burst = burst
+        self.state_file = state_file
+        self.tokens = float(burst)
+        self.updated = time.time()
+        if state_file is not None and state_file.exists():
+            try:
+                state = json.loads(state_file.read_text())
+                self.tokens, self.updated = float(state["tokens"]), float(state["updated"])
+            except (ValueError, KeyError, TypeError):
+                pass  # Битый файл — начинаем с полного ведра
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Взять токен, при необходимости дождавшись его"""
+        self._refill()
+        if self.tokens < 1:
+            wait = (1 - self.tokens) / self.rate
+            print(f"⏳ Лимит публикаций: ждём {wait:.0f} сек")
+            time.sleep(wait)
+            self._refill()
+        self.tokens -= 1
+        if self.state_file is not None:
+            self.state_file.write_text(json.dumps({"tokens": self.tokens, "updated": self.updated}))
+
+def is_rate_limited(error: Exception) -> bool:
+    """Instagram ответил 429 или попросил подождать"""
+    if type(error).__name__ in RATE_LIMIT_ERRORS:
+        return True
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) == 429
+
 def publish_photo(client, image_path: Path, caption: str):
     """Опубликовать одно фото"""
     return client.photo_upload(str(image_path), caption)
@@ -90,21 +204,57 @@ def publish_reels(client, video_path: Path, caption: str):
     """Опубликовать Reels"""
     return client.clip_upload(str(video_path), caption)
 
-def update_queue(business: str, draft_name: str, status: str = "📤 Опубликован"):
-    """Обновить статус в _queue.md"""
+def publish_draft(client, draft: DraftBundle):
+    """Опубликовать черновик в нужном формате"""
+    if draft.meta["format"] == "album" and len(draft.images) > 1:
+        return publish_album(client, draft.images, draft.caption)
+    if draft.meta["format"] == "reels":
+        if draft.videos:
+            return publish_reels(client, draft.videos[0], draft.caption)
+        print("⚠️ Нет видео для Reels, публикуем как фото")
+    return publish_photo(client, draft.images[0], draft.caption)
+
+def publish_with_backoff(client, bucket: TokenBucket, draft: DraftBundle):
+    """Опубликовать через лимитер; на rate limit — пауза 60–300 сек × 2^попытка и повтор"""
+    for attempt in range(PUBLISH_RETRIES):
+        bucket.acquire()
+        try:
+            return publish_draft(client, draft)
+        except Exception as e:
+            if not is_rate_limited(e) or attempt == PUBLISH_RETRIES - 1:
+                raise
+            delay = random.uniform(60, 300) * 2 ** attempt
+            print(f"⏳ Instagram просит подождать ({e}), пауза {delay:.0f} сек")
+            time.sleep(delay)
+
+def update_queue(business: str, statuses: dict, drafts: dict = None, selected: dict = None):
+    """Обновить статусы в _queue.md за одну запись: {имя черновика: новый статус}
+
+    selected — {имя черновика: строки очереди, по которым его выбрали}: если передан,
+    переписываем только эти строки, а не всё, что сопоставилось с папкой.
+    """
     queue_file = BUSINESSES_DIR / business / "drafts" / "_queue.md"
-    if queue_file.exists():
-        content = queue_file.read_text()
-        # Найти строку с этим черновиком и обновить статус
-        lines = content.split("\n")
-        updated_lines = []
-        for line in lines:
-            if draft_name in line and "⏳" in line:
-                line = line.replace("⏳ На одобрении", status)
-            elif draft_name in line and "✅" in line:
-                line = line.replace("✅ Одобрен", status)
-            updated_lines.append(line)
-        queue_file.write_text("\n".join(updated_lines))
+    if not statuses or not queue_file.exists():
+        return
+    if drafts is None:
+        drafts = list_drafts(business)
+    content = read_utf8(queue_file)
+
+    # Меняем только ячейку «Статус» найденных строк, остальной текст копируем срезами
+    parts = []
+    pos = 0
+    for draft_name, row in parse_queue(content, drafts):
+        status = statuses.get(draft_name)
+        if status is None or row.group(5).strip() not in PENDING_STATUSES:
+            continue
+        if selected is not None and row.group(0) not in selected.get(draft_name, ()):
+            continue
+        start, end = row.span(5)
+        parts.append(content[pos:start])
+        parts.append(f" {status} ")
+        pos = end
+    parts.append(content[pos:])
+    write_utf8(queue_file, "".join(parts))
 
 def main():
     parser = argparse.ArgumentParser(description="Публикация Instagram-контента из drafts/")
@@ -124,25 +274,26 @@ def main():
         print(f"   INSTAGRAM_PASSWORD=your_password")
         sys.exit(1)
     
-    # Определить черновики для публикации
+    # Определить черновики для публикации; папки читаем один раз — дальше проверка по словарю
+    drafts = list_drafts(args.business)
     drafts_to_publish = []
+    selected = None  # для --all-approved: {черновик: строки очереди, по которым он выбран}
     if args.draft:
         drafts_to_publish.append(args.draft)
     elif args.all_approved:
         queue_file = BUSINESSES_DIR / args.business / "drafts" / "_queue.md"
+        selected = {}
         if queue_file.exists():
-            for line in queue_file.read_text().split("\n"):
-                if "✅ Одобрен" in line and "Instagram" in line:
-                    # Извлечь имя черновика из строки
-                    parts = line.split("|")
-                    if len(parts) >= 5:
-                        draft_desc = parts[4].strip()
-                        # Ищем папку по описанию
-                        drafts_dir = BUSINESSES_DIR / args.business / "drafts" / "instagram"
-                        if drafts_dir.exists():
-                            for d in drafts_dir.iterdir():
-                                if d.is_dir() and not d.name.startswith("_"):
-                                    drafts_to_publish.append(d.name)
+            for draft_name, row in parse_queue(read_utf8(queue_file), drafts):
+                if row.group(5).strip() != "✅ Одобрен":
+                    continue
+                if draft_name is None:
+                    print(f"⚠️ Не нашли папку черновика для строки: {row.group(0).strip()}")
+                    continue
+                if draft_name not in selected:
+                    selected[draft_name] = set()
+                    drafts_to_publish.append(draft_name)
+                selected[draft_name].add(row.group(0))
     
     if not drafts_to_publish:
         print("📭 Нет черновиков для публикации")
@@ -158,47 +309,45 @@ def main():
         except Exception as e:
             print(f"❌ Ошибка входа: {e}")
             sys.exit(1)
+        state_file = BUSINESSES_DIR / args.business / "drafts" / RATE_STATE_FILE
+        bucket = TokenBucket(PUBLISH_RATE_PER_MIN, PUBLISH_BURST, state_file)
     
-    # Публиковать каждый черновик
-    for draft_name in drafts_to_publish:
-        draft_path = get_draft_path(args.business, draft_name)
-        if not draft_path.exists():
-            print(f"⚠️ Черновик не найден: {draft_path}")
-            continue
+    # Публиковать каждый черновик; статусы пишем в _queue.md один раз в конце
+    statuses = {}
+    try:
+        for draft_name in drafts_to_publish:
+            draft_path = drafts.get(draft_name)
+            if draft_path is None:
+                print(f"⚠️ Черновик не найден: {get_draft_path(args.business, draft_name)}")
+                continue
         
-        caption = read_caption(draft_path)
-        images = get_images(draft_path)
-        meta = read_meta(draft_path)
+            draft = inspect_draft(draft_path)
         
-        print(f"\n{'='*50}")
-        print(f"📱 Черновик: {draft_name}")
-        print(f"📝 Формат: {meta['format']}")
-        print(f"🖼 Изображений: {len(images)}")
-        print(f"📝 Подпись: {caption[:100]}...")
+            print(f"\n{'='*50}")
+            print(f"📱 Черновик: {draft_name}")
+            print(f"📝 Формат: {draft.meta['format']}")
+            print(f"🖼 Изображений: {len(draft.images)}")
+            print(f"📝 Подпись: {draft.caption[:100]}...")
         
-        if args.dry_run:
-            print("🏃 DRY RUN — пропускаем публикацию")
-            continue
+            if args.dry_run:
+                print("🏃 DRY RUN — пропускаем публикацию")
+                continue
         
-        try:
-            if meta["format"] == "album" and len(images) > 1:
-                result = publish_album(client, images, caption)
-            elif meta["format"] == "reels":
-                videos = [f for f in draft_path.iterdir() if f.suffix in {".mp4", ".mov"}]
-                if videos:
-                    result = publish_reels(client, videos[0], caption)
-                else:
-                    print("⚠️ Нет видео для Reels, публикуем как фото")
-                    result = publish_photo(client, images[0], caption)
-            else:
-                result = publish_photo(client, images[0], caption)
+            try:
+                result = publish_with_backoff(client, bucket, draft)
+                print(f"✅ Опубликовано! ID: {result.pk}")
+                statuses[draft_name] = "📤 Опубликован"
             
-            print(f"✅ Опубликовано! ID: {result.pk}")
-            update_queue(args.business, draft_name)
-            
-        except Exception as e:
-            print(f"❌ Ошибка: {e}")
-            update_queue(args.business, draft_name, "❌ Ошибка")
+            except Exception as e:
+                if is_rate_limited(e):
+                    # Статус не трогаем: оставшиеся черновики подхватит следующий запуск cron
+                    print(f"❌ Instagram ограничил публикации: {e}")
+                    print("   Остальные черновики остаются в очереди до следующего запуска")
+                    break
+                print(f"❌ Ошибка: {e}")
+                statuses[draft_name] = "❌ Ошибка"
+    finally:
+        update_queue(args.business, statuses, drafts, selected)
 
 if __name__ == "__main__":
     main()
@@ -15,23 +15,15 @@ import os
 import sys
 import json
 import argparse
-import requests
 from pathlib import Path
 
+from _credentials import load_credentials
+from _http import make_session, json_dumps, json_loads
+
 BUSINESSES_DIR = Path(__file__).parent.parent / "businesses"
 API_URL = "https://api.direct.yandex.com/json/v5/"
 SANDBOX_URL = "https://api-sandbox.direct.yandex.com/json/v5/"
-
-def load_credentials(business: str) -> dict:
-    """Загрузить credentials из businesses/{name}/.credentials"""
-    cred_file = BUSINESSES_DIR / business / ".credentials"
-    env = {}
-    if cred_file.exists():
-        for line in cred_file.read_text().splitlines():
-            if "=" in line and not line.startswith("#"):
-                key, value = line.split("=", 1)
-                env[key.strip()] = value.strip()
-    return env
+BATCH_SIZE = 1000  # максимум объектов в одном add-запросе API v5
 
 class YandexDirectClient:
     def __init__(self, token: str, login: str, sandbox: bool = False):
@@ -44,6 +36,9 @@ class YandexDirectClient:
             "Accept-Language": "ru",
             "Content-Type": "application/json; charset=utf-8",
         }
+        # Одна keep-alive сессия на клиента: TLS-рукопожатие один раз на все запросы
+        self.session = make_session(self.headers)
+        self._campaigns_cache = None
     
     def request(self, service: str, method: str, params: dict = None) -> dict:
         """Выполнить запрос к API"""
@@ -52,8 +47,8 @@ class YandexDirectClient:
         if params:
             body["params"] = params
         
-        response = requests.post(url, json=body, headers=self.headers)
-        result = response.json()
+        response = self.session.post(url, data=json_dumps(body))
+        result = json_loads(response.content)
         
         if "error" in result:
             raise Exception(f"API Error: {result['error']['error_string']} - {result['error'].get('error_detail', '')}")
@@ -63,12 +58,14 @@ class YandexDirectClient:
     # === Кампании ===
     
     def list_campaigns(self) -> list:
-        """Получить список кампаний"""
-        result = self.request("campaigns", "get", {
-            "SelectionCriteria": {},
-            "FieldNames": ["Id", "Name", "Status", "State", "DailyBudget"]
-        })
-        return result.get("Campaigns", [])
+        """Получить список кампаний (кэшируется на время жизни клиента)"""
+        if self._campaigns_cache is None:
+            result = self.request("campaigns", "get", {
+                "SelectionCriteria": {},
+                "FieldNames": ["Id", "Name", "Status", "State", "DailyBudget"]
+            })
+            self._campaigns_cache = result.get("Campaigns", [])
+        return self._campaigns_cache
     
     def create_campaign(self, name: str, daily_budget_micros: int = 30000000) -> int:
         """Создать текстово-графическую кампанию"""
@@ -93,37 +90,50 @@ class YandexDirectClient:
             }]
         })
         campaign_id = result["AddResults"][0]["Id"]
+        self._campaigns_cache = None  # список кампаний изменился
         return campaign_id
     
+    # === Пакетное добавление ===
+    
+    def add_batch(self, service: str, key: str, items: list) -> list:
+        """Добавить объекты пачками по BATCH_SIZE за запрос, вернуть все AddResults"""
+        add_results = []
+        for i in range(0, len(items), BATCH_SIZE):
+            result = self.request(service, "add", {key: items[i:i + BATCH_SIZE]})
+            add_results.extend(result.get("AddResults", []))
+        return add_results
+    
     # === Группы объявлений ===
     
+    def create_ad_groups(self, ad_groups: list) -> list:
+        """Создать группы объявлений одним запросом (AddResults в том же порядке)"""
+        return self.add_batch("adgroups", "AdGroups", ad_groups)
+    
     def create_ad_group(self, campaign_id: int, name: str, region_ids: list = None) -> int:
         """Создать группу объявлений"""
         if region_ids is None:
             region_ids = [225, 159]  # Россия + Казахстан
         
-        result = self.request("adgroups", "add", {
-            "AdGroups": [{
-                "Name": name,
-                "CampaignId": campaign_id,
-                "RegionIds": region_ids
-            }]
-        })
-        return result["AddResults"][0]["Id"]
+        add_results = self.create_ad_groups([{
+            "Name": name,
+            "CampaignId": campaign_id,
+            "RegionIds": region_ids
+        }])
+        return add_results[0]["Id"]
     
     # === Ключевые слова ===
     
     def add_keywords(self, ad_group_id: int, keywords: list) -> list:
         """Добавить ключевые слова"""
         kw_items = [{"Keyword": kw, "AdGroupId": ad_group_id} for kw in keywords]
-        result = self.request("keywords", "add", {"Keywords": kw_items})
-        return result.get("AddResults", [])
+        return self.add_batch("keywords", "Keywords", kw_items)
     
     # === Объявления ===
     
-    def create_ad(self, ad_group_id: int, title: str, title2: str, 
-                  text: str, url: str, display_url: str = None) -> int:
-        """Создать текстовое объявление"""
+    @staticmethod
+    def make_text_ad(ad_group_id: int, title: str, title2: str,
+                     text: str, url: str, display_url: str = None) -> dict:
+        """Собрать текстовое объявление для create_ads"""
         ad = {
             "AdGroupId": ad_group_id,
             "TextAd": {
@@ -136,15 +146,22 @@ class YandexDirectClient:
         }
         if display_url:
             ad["TextAd"]["DisplayUrlPath"] = display_url
-        
-        result = self.request("ads", "add", {"Ads": [ad]})
-        add_result = result["AddResults"][0]
+        return ad
+    
+    def create_ads(self, ads: list) -> list:
+        """Создать объявления одним запросом (AddResults в том же порядке)"""
+        return self.add_batch("ads", "Ads", ads)
+    
+    def create_ad(self, ad_group_id: int, title: str, title2: str, 
+                  text: str, url: str, display_url: str = None) -> int:
+        """Создать текстовое объявление"""
+        ad = self.make_text_ad(ad_group_id, title, title2, text, url, display_url)
+        add_result = self.create_ads([ad])[0]
         if "Id" in add_result:
             return add_result["Id"]
         else:
             raise Exception(f"Ad creation failed: {add_result.get('Errors', add_result)}")
 
-
 def test_connection(client: YandexDirectClient):
     """Проверить подключение к API"""
     try:
@@ -7,35 +7,36 @@ Yandex.Direct Stats Collector for PowerDemon.AI
   python3 scripts/yandex_direct_stats.py --business netashi
   python3 scripts/yandex_direct_stats.py --business netashi --days 7
   python3 scripts/yandex_direct_stats.py --business netashi --campaign-id 707523702
+  python3 scripts/yandex_direct_stats.py --business netashi other_business
 
 Cron (ежедневно в 8:00):
   0 8 * * * cd /Users/pavelrasputin/Desktop/Antygravity && python3 scripts/yandex_direct_stats.py --business netashi
 """
 
+import io
 import sys
+import csv
 import json
+import time
 import argparse
 import requests
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+from _credentials import load_credentials
+from _http import make_session, json_dumps
+
 BUSINESSES_DIR = Path(__file__).parent.parent / "businesses"
 API_URL = "https://api.direct.yandex.com/json/v5/"
+REPORT_TIMEOUT = 120  # сек. на формирование офлайн-отчёта
 
 
-def load_credentials(business: str) -> dict:
-    cred_file = BUSINESSES_DIR / business / ".credentials"
-    env = {}
-    if cred_file.exists():
-        for line in cred_file.read_text().splitlines():
-            if "=" in line and not line.startswith("#"):
-                k, v = line.split("=", 1)
-                env[k.strip()] = v.strip()
-    return env
-
-
-def get_report(token: str, login: str, date_from: str, date_to: str, campaign_ids: list = None):
+def get_report(token: str, login: str, date_from: str, date_to: str, campaign_ids: list = None,
+               session: requests.Session = None):
     """Получить статистику через Reports API"""
+    if session is None:
+        session = make_session(retry_post=True)
     headers = {
         "Authorization": f"Bearer {token}",
         "Client-Login": login,
@@ -63,99 +64,93 @@ def get_report(token: str, login: str, date_from: str, date_to: str, campaign_id
         }
     }
 
-    response = requests.post(API_URL + "reports", json=body, headers=headers)
-
-    if response.status_code == 200:
-        return response.text
-    elif response.status_code == 201:
-        # Отчёт формируется, нужно подождать
-        import time
-        for _ in range(10):
-            time.sleep(5)
-            response = requests.post(API_URL + "reports", json=body, headers=headers)
-            if response.status_code == 200:
-                return response.text
-        raise Exception("Отчёт не сформировался за 50 секунд")
-    else:
-        raise Exception(f"API Error {response.status_code}: {response.text}")
+    # 201/202 — отчёт формируется: ждём, сколько советует API (retryIn),
+    # иначе с экспоненциальной паузой 0.5, 1, 2, 4… сек (не больше 10)
+    deadline = time.monotonic() + REPORT_TIMEOUT
+    attempt = 0
+    payload = json_dumps(body)
+    while True:
+        response = session.post(API_URL + "reports", data=payload, headers=headers)
+        if response.status_code == 200:
+            return response.text
+        if response.status_code not in (201, 202):
+            raise Exception(f"API Error {response.status_code}: {response.text}")
+
+        retry_in = response.headers.get("retryIn")
+        delay = float(retry_in) if retry_in else min(0.5 * 2 ** attempt, 10)
+        if time.monotonic() + delay > deadline:
+            raise Exception(f"Отчёт не сформировался за {REPORT_TIMEOUT} секунд")
+        time.sleep(delay)
+        attempt += 1
 
 
 def parse_tsv(tsv_data: str) -> list:
     """Парсим TSV в список словарей"""
-    lines = tsv_data.strip().split("\n")
-    if not lines:
-        return []
-
-    headers = lines[0].split("\t")
-    rows = []
-    for line in lines[1:]:
-        values = line.split("\t")
-        row = dict(zip(headers, values))
-        rows.append(row)
-    return rows
+    # Reports API отдаёт TSV без кавычек — кавычки в названиях групп оставляем как есть
+    reader = csv.DictReader(io.StringIO(tsv_data.strip()), delimiter="\t", quoting=csv.QUOTE_NONE)
+    return list(reader)
 
 
 def generate_report_md(rows: list, date_from: str, date_to: str, business: str) -> str:
     """Сформировать MD-отчёт"""
-    report = f"# Отчёт Яндекс.Директ: {business}\n"
-    report += f"**Период:** {date_from} — {date_to}\n"
-    report += f"**Дата формирования:** {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"
+    parts = [f"# Отчёт Яндекс.Директ: {business}\n"]
+    append = parts.append
+    append(f"**Период:** {date_from} — {date_to}\n")
+    append(f"**Дата формирования:** {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n")
 
     if not rows:
-        report += "> Нет данных за указанный период. Кампания, возможно, ещё на модерации.\n"
-        return report
+        append("> Нет данных за указанный период. Кампания, возможно, ещё на модерации.\n")
+        return "".join(parts)
 
-    # Сводка
-    total_impressions = sum(int(r.get("Impressions", 0)) for r in rows)
-    total_clicks = sum(int(r.get("Clicks", 0)) for r in rows)
-    total_cost = sum(float(r.get("Cost", 0)) for r in rows)
+    # Один проход по строкам: итоги, группы и дни сразу; [показы, клики, расход]
+    total_impressions = total_clicks = 0
+    total_cost = 0.0
+    groups = {}
+    days = {}
+    for r in rows:
+        imp = int(r.get("Impressions", 0))
+        clk = int(r.get("Clicks", 0))
+        cost = float(r.get("Cost", 0))
+        total_impressions += imp
+        total_clicks += clk
+        total_cost += cost
+        g = groups.setdefault(r.get("AdGroupName", "—"), [0, 0, 0.0])
+        g[0] += imp
+        g[1] += clk
+        g[2] += cost
+        d = days.setdefault(r.get("Date", "—"), [0, 0, 0.0])
+        d[0] += imp
+        d[1] += clk
+        d[2] += cost
     avg_ctr = (total_clicks / total_impressions * 100) if total_impressions > 0 else 0
 
-    report += "## Сводка\n\n"
-    report += "| Показы | Клики | CTR | Расход |\n"
-    report += "|--------|-------|-----|--------|\n"
-    report += f"| {total_impressions} | {total_clicks} | {avg_ctr:.1f}% | {total_cost:.0f}₽ |\n\n"
+    # Сводка
+    append("## Сводка\n\n")
+    append("| Показы | Клики | CTR | Расход |\n")
+    append("|--------|-------|-----|--------|\n")
+    append(f"| {total_impressions} | {total_clicks} | {avg_ctr:.1f}% | {total_cost:.0f}₽ |\n\n")
 
     # По группам
-    groups = {}
-    for r in rows:
-        gname = r.get("AdGroupName", "—")
-        if gname not in groups:
-            groups[gname] = {"impressions": 0, "clicks": 0, "cost": 0}
-        groups[gname]["impressions"] += int(r.get("Impressions", 0))
-        groups[gname]["clicks"] += int(r.get("Clicks", 0))
-        groups[gname]["cost"] += float(r.get("Cost", 0))
-
-    report += "## По группам\n\n"
-    report += "| Группа | Показы | Клики | CTR | Расход |\n"
-    report += "|--------|--------|-------|-----|--------|\n"
-    for gname, data in sorted(groups.items(), key=lambda x: x[1]["clicks"], reverse=True):
-        ctr = (data["clicks"] / data["impressions"] * 100) if data["impressions"] > 0 else 0
+    append("## По группам\n\n")
+    append("| Группа | Показы | Клики | CTR | Расход |\n")
+    append("|--------|--------|-------|-----|--------|\n")
+    for gname, (imp, clk, cost) in sorted(groups.items(), key=lambda x: x[1][1], reverse=True):
+        ctr = (clk / imp * 100) if imp > 0 else 0
         flag = "⚠️" if ctr < 3 else "✅" if ctr > 7 else ""
-        report += f"| {gname} | {data['impressions']} | {data['clicks']} | {ctr:.1f}% {flag} | {data['cost']:.0f}₽ |\n"
+        append(f"| {gname} | {imp} | {clk} | {ctr:.1f}% {flag} | {cost:.0f}₽ |\n")
 
-    report += "\n"
+    append("\n")
 
     # По дням
-    days = {}
-    for r in rows:
-        d = r.get("Date", "—")
-        if d not in days:
-            days[d] = {"impressions": 0, "clicks": 0, "cost": 0}
-        days[d]["impressions"] += int(r.get("Impressions", 0))
-        days[d]["clicks"] += int(r.get("Clicks", 0))
-        days[d]["cost"] += float(r.get("Cost", 0))
-
-    report += "## По дням\n\n"
-    report += "| Дата | Показы | Клики | Расход |\n"
-    report += "|------|--------|-------|--------|\n"
-    for d in sorted(days.keys()):
-        data = days[d]
-        report += f"| {d} | {data['impressions']} | {data['clicks']} | {data['cost']:.0f}₽ |\n"
-
-    report += "\n---\n*Сгенерировано автоматически скриптом yandex_direct_stats.py*\n"
-    return report
-import csv
+    append("## По дням\n\n")
+    append("| Дата | Показы | Клики | Расход |\n")
+    append("|------|--------|-------|--------|\n")
+    for d in sorted(days):
+        imp, clk, cost = days[d]
+        append(f"| {d} | {imp} | {clk} | {cost:.0f}₽ |\n")
+
+    append("\n---\n*Сгенерировано автоматически скриптом yandex_direct_stats.py*\n")
+    return "".join(parts)
 
 
 def append_to_csv(rows: list, csv_path: Path):
@@ -200,58 +195,92 @@ def append_to_csv(rows: list, csv_path: Path):
     print(f"   CSV: +{len(new_rows)} строк → {csv_path.name}")
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Сбор статистики Яндекс.Директ")
-    parser.add_argument("--business", required=True)
-    parser.add_argument("--days", type=int, default=1, help="За сколько дней (по умолчанию 1 = вчера)")
-    parser.add_argument("--campaign-id", type=int, help="ID конкретной кампании")
-    args = parser.parse_args()
-
-    creds = load_credentials(args.business)
+def collect_business(business: str, date_from: str, date_to: str, campaign_ids: list = None,
+                     session: requests.Session = None) -> str:
+    """Собрать статистику одного бизнеса: MD-отчёт + CSV. Возвращает текст отчёта"""
+    creds = load_credentials(business)
     token = creds.get("YANDEX_DIRECT_TOKEN")
     login = creds.get("YANDEX_DIRECT_LOGIN")
 
     if not token or not login:
-        print(f"❌ Нет credentials в businesses/{args.business}/.credentials")
-        sys.exit(1)
+        raise Exception(f"Нет credentials в businesses/{business}/.credentials")
 
-    # По умолчанию: вчерашний день
-    date_to = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-    date_from = (datetime.now() - timedelta(days=args.days)).strftime("%Y-%m-%d")
+    print(f"📊 Собираем статистику {business} за {date_from} — {date_to}...")
 
-    campaign_ids = [args.campaign_id] if args.campaign_id else None
+    tsv_data = get_report(token, login, date_from, date_to, campaign_ids, session=session)
+    rows = parse_tsv(tsv_data)
+    print(f"   {business}: строк данных: {len(rows)}")
+
+    # Папка отчётов
+    reports_dir = BUSINESSES_DIR / business / "projects" / "yandex-direct" / "reports"
+    reports_dir.mkdir(parents=True, exist_ok=True)
 
-    print(f"📊 Собираем статистику {args.business} за {date_from} — {date_to}...")
+    # 1. MD-отчёт (один файл на запрос)
+    report_md = generate_report_md(rows, date_from, date_to, business)
+    md_filename = f"report_{date_from}.md"
+    md_path = reports_dir / md_filename
+    md_path.write_bytes(report_md.encode("utf-8"))
+    print(f"✅ {business}: MD-отчёт {md_filename}")
 
-    try:
-        tsv_data = get_report(token, login, date_from, date_to, campaign_ids)
-        rows = parse_tsv(tsv_data)
-        print(f"   Строк данных: {len(rows)}")
+    # 2. Кумулятивный CSV (один файл, дополняется каждый день)
+    csv_path = reports_dir / "stats.csv"
+    append_to_csv(rows, csv_path)
+    print(f"✅ {business}: CSV stats.csv")
 
-        # Папка отчётов
-        reports_dir = BUSINESSES_DIR / args.business / "projects" / "yandex-direct" / "reports"
-        reports_dir.mkdir(parents=True, exist_ok=True)
+    return report_md
 
-        # 1. MD-отчёт (один файл на запрос)
-        report_md = generate_report_md(rows, date_from, date_to, args.business)
-        md_filename = f"report_{date_from}.md"
-        md_path = reports_dir / md_filename
-        md_path.write_text(report_md)
-        print(f"✅ MD-отчёт: {md_filename}")
 
-        # 2. Кумулятивный CSV (один файл, дополняется каждый день)
-        csv_path = reports_dir / "stats.csv"
-        append_to_csv(rows, csv_path)
-        print(f"✅ CSV: stats.csv")
+def collect_login_group(businesses: list, date_from: str, date_to: str, campaign_ids: list = None) -> dict:
+    """Бизнесы с одним логином — последовательно, через одну сессию. {бизнес: отчёт или ошибка}"""
+    session = make_session(retry_post=True)
+    results = {}
+    for business in businesses:
+        try:
+            results[business] = collect_business(business, date_from, date_to, campaign_ids, session)
+        except Exception as e:
+            results[business] = e
+    return results
 
-        # Вывести сводку в консоль
-        print("\n" + report_md)
 
-    except Exception as e:
-        print(f"❌ Ошибка: {e}")
+def main():
+    parser = argparse.ArgumentParser(description="Сбор статистики Яндекс.Директ")
+    parser.add_argument("--business", required=True, nargs="+", help="Один или несколько бизнесов")
+    parser.add_argument("--days", type=int, default=1, help="За сколько дней (по умолчанию 1 = вчера)")
+    parser.add_argument("--campaign-id", type=int, help="ID конкретной кампании")
+    args = parser.parse_args()
+
+    # По умолчанию: вчерашний день
+    date_to = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    date_from = (datetime.now() - timedelta(days=args.days)).strftime("%Y-%m-%d")
+
+    campaign_ids = [args.campaign_id] if args.campaign_id else None
+
+    # Разные логины опрашиваем параллельно, один логин — по очереди (лимиты API на логин)
+    by_login = {}
+    for business in args.business:
+        login = load_credentials(business).get("YANDEX_DIRECT_LOGIN", "")
+        by_login.setdefault(login, []).append(business)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(by_login)) as pool:
+        futures = [pool.submit(collect_login_group, group, date_from, date_to, campaign_ids)
+                   for group in by_login.values()]
+        for future in futures:
+            results.update(future.result())
+
+    failed = False
+    for business in args.business:
+        result = results[business]
+        if isinstance(result, Exception):
+            print(f"❌ Ошибка ({business}): {result}")
+            failed = True
+        else:
+            # Вывести сводку в консоль
+            print("\n" + result)
+
+    if failed:
         sys.exit(1)
 
 
 if __name__ == "__main__":
     main()
-
@@ -6,6 +6,7 @@ Yandex.Metrica Stats Collector for PowerDemon.AI
 Использование:
   python3 scripts/yandex_metrica_stats.py --business netashi
   python3 scripts/yandex_metrica_stats.py --business netashi --days 7
+  python3 scripts/yandex_metrica_stats.py --business netashi --days 30 --only-missing
 
 Credentials: businesses/{name}/.credentials
   YANDEX_METRICA_COUNTER=12345678
@@ -15,28 +16,55 @@ Credentials: businesses/{name}/.credentials
 import sys
 import csv
 import argparse
-import requests
+import threading
 from pathlib import Path
+from itertools import islice
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+from _credentials import load_credentials
+from _http import make_cached_session, json_loads
+
 BUSINESSES_DIR = Path(__file__).parent.parent / "businesses"
 METRICA_API = "https://api-metrika.yandex.net/stat/v1/data"
-
-
-def load_credentials(business: str) -> dict:
-    cred_file = BUSINESSES_DIR / business / ".credentials"
-    env = {}
-    if cred_file.exists():
-        for line in cred_file.read_text().splitlines():
-            if "=" in line and not line.startswith("#"):
-                k, v = line.split("=", 1)
-                env[k.strip()] = v.strip()
-    return env
+REQUEST_TIMEOUT = (5, 30)  # сек.: соединение, чтение
+PAGE_LIMIT = 10000  # максимум строк на страницу в API Метрики
+MAX_PARALLEL_REQUESTS = 3  # лимит API Метрики на параллельные запросы одного пользователя
+CACHE_PATH = "~/.cache/powerdemon/metrica"  # SQLite-кэш ответов (если стоит requests-cache)
+CACHE_TTL = 6 * 3600  # сек.: повторный запуск в течение 6 часов не ходит в API
+
+# Одна keep-alive сессия на процесс: все запросы к API идут по уже открытому соединению;
+# 429 и 5xx повторяются на месте, не перезапуская остальные запросы.
+# Создаётся при первом запросе, чтобы импорт и --help не трогали кэш на диске
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+# Общий на все потоки счётчик одновременных запросов: и отчёты, и их страницы
+_API_SLOTS = threading.BoundedSemaphore(MAX_PARALLEL_REQUESTS)
+
+
+def _get_session():
+    """Общая сессия API (создаётся один раз, потокобезопасно)"""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = make_cached_session(CACHE_PATH, CACHE_TTL, rate_limited=True)
+    return _SESSION
+
+
+def _fetch_page(headers: dict, params: dict) -> dict:
+    """Одна страница ответа API (не больше MAX_PARALLEL_REQUESTS одновременно)"""
+    with _API_SLOTS:
+        response = _get_session().get(METRICA_API, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
+    if response.status_code != 200:
+        raise Exception(f"Metrica API Error {response.status_code}: {response.text}")
+    return json_loads(response.content)
 
 
 def get_metrica_data(token: str, counter_id: str, date_from: str, date_to: str,
-                     metrics: str, dimensions: str = "ym:s:date", group: str = "day"):
-    """Запрос к API Яндекс.Метрики"""
+                     metrics: str, dimensions: str = "ym:s:date", group: str = "day",
+                     limit: int = PAGE_LIMIT):
+    """Запрос к API Яндекс.Метрики (все страницы, если строк больше limit)"""
     headers = {"Authorization": f"OAuth {token}"}
     params = {
         "ids": counter_id,
@@ -45,12 +73,19 @@ def get_metrica_data(token: str, counter_id: str, date_from: str, date_to: str,
         "metrics": metrics,
         "dimensions": dimensions,
         "group": group,
-        "limit": 100,
+        "limit": limit,
     }
-    response = requests.get(METRICA_API, headers=headers, params=params)
-    if response.status_code != 200:
-        raise Exception(f"Metrica API Error {response.status_code}: {response.text}")
-    return response.json()
+    data = _fetch_page(headers, params)
+
+    # Остальные страницы (offset считается с 1) запрашиваем параллельно — в пределах _API_SLOTS
+    rows = data.setdefault("data", [])
+    offsets = range(limit + 1, data.get("total_rows", 0) + 1, limit)
+    if rows and offsets:
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_REQUESTS, len(offsets))) as pool:
+            pages = pool.map(lambda offset: _fetch_page(headers, {**params, "offset": offset}), offsets)
+            for page in pages:
+                rows.extend(page.get("data", []))
+    return data
 
 
 def get_traffic_summary(token: str, counter_id: str, date_from: str, date_to: str) -> list:
@@ -58,19 +93,17 @@ def get_traffic_summary(token: str, counter_id: str, date_from: str, date_to: st
     metrics = "ym:s:visits,ym:s:users,ym:s:pageviews,ym:s:bounceRate,ym:s:avgVisitDurationSeconds"
     data = get_metrica_data(token, counter_id, date_from, date_to, metrics)
 
-    rows = []
-    for item in data.get("data", []):
-        date = item["dimensions"][0]["name"]
-        m = item["metrics"]
-        rows.append({
-            "date": date,
-            "visits": int(m[0]),
-            "users": int(m[1]),
-            "pageviews": int(m[2]),
-            "bounce_rate": round(m[3], 1),
-            "avg_duration": round(m[4], 0),
-        })
-    return rows
+    return [
+        {
+            "date": item["dimensions"][0]["name"],
+            "visits": int(item["metrics"][0]),
+            "users": int(item["metrics"][1]),
+            "pageviews": int(item["metrics"][2]),
+            "bounce_rate": round(item["metrics"][3], 1),
+            "avg_duration": round(item["metrics"][4], 0),
+        }
+        for item in data.get("data", [])
+    ]
 
 
 def get_traffic_sources(token: str, counter_id: str, date_from: str, date_to: str) -> list:
@@ -79,17 +112,15 @@ def get_traffic_sources(token: str, counter_id: str, date_from: str, date_to: st
     dimensions = "ym:s:lastTrafficSource"
     data = get_metrica_data(token, counter_id, date_from, date_to, metrics, dimensions)
 
-    rows = []
-    for item in data.get("data", []):
-        source = item["dimensions"][0]["name"]
-        m = item["metrics"]
-        rows.append({
-            "source": source,
-            "visits": int(m[0]),
-            "users": int(m[1]),
-            "bounce_rate": round(m[2], 1),
-        })
-    return rows
+    return [
+        {
+            "source": item["dimensions"][0]["name"],
+            "visits": int(item["metrics"][0]),
+            "users": int(item["metrics"][1]),
+            "bounce_rate": round(item["metrics"][2], 1),
+        }
+        for item in data.get("data", [])
+    ]
 
 
 def get_search_queries(token: str, counter_id: str, date_from: str, date_to: str) -> list:
@@ -102,96 +133,116 @@ def get_search_queries(token: str, counter_id: str, date_from: str, date_to: str
     for item in data.get("data", []):
         query = item["dimensions"][0]["name"]
         if query and query != "(not set)":
-            rows.append({
-                "query": query,
-                "visits": int(item["metrics"][0]),
-            })
-    return sorted(rows, key=lambda x: x["visits"], reverse=True)
+            rows.append({"query": query, "visits": int(item["metrics"][0])})
+    rows.sort(key=itemgetter("visits"), reverse=True)
+    return rows
 
 
 def generate_report_md(traffic: list, sources: list, queries: list,
                        date_from: str, date_to: str, business: str) -> str:
     """Сформировать MD-отчёт по Метрике"""
-    report = f"# Отчёт Яндекс.Метрика: {business}\n"
-    report += f"**Период:** {date_from} — {date_to}\n"
-    report += f"**Дата формирования:** {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"
+    parts = [f"# Отчёт Яндекс.Метрика: {business}\n"]
+    append = parts.append
+    append(f"**Период:** {date_from} — {date_to}\n")
+    append(f"**Дата формирования:** {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n")
 
     if not traffic:
-        report += "> Нет данных за указанный период.\n"
-        return report
+        append("> Нет данных за указанный период.\n")
+        return "".join(parts)
 
     # Сводка
-    total_visits = sum(r["visits"] for r in traffic)
-    total_users = sum(r["users"] for r in traffic)
-    total_views = sum(r["pageviews"] for r in traffic)
-    avg_bounce = sum(r["bounce_rate"] for r in traffic) / len(traffic) if traffic else 0
-    avg_duration = sum(r["avg_duration"] for r in traffic) / len(traffic) if traffic else 0
-
-    report += "## Сводка\n\n"
-    report += "| Визиты | Пользователи | Просмотры | Отказы | Ср. время |\n"
-    report += "|--------|-------------|-----------|--------|----------|\n"
+    # Все пять показателей за один проход по дням
+    total_visits = total_users = total_views = 0
+    sum_bounce = sum_duration = 0
+    for r in traffic:
+        total_visits += r["visits"]
+        total_users += r["users"]
+        total_views += r["pageviews"]
+        sum_bounce += r["bounce_rate"]
+        sum_duration += r["avg_duration"]
+    avg_bounce = sum_bounce / len(traffic)
+    avg_duration = sum_duration / len(traffic)
+
+    append("## Сводка\n\n")
+    append("| Визиты | Пользователи | Просмотры | Отказы | Ср. время |\n")
+    append("|--------|-------------|-----------|--------|----------|\n")
     bounce_flag = "⚠️" if avg_bounce > 50 else "✅"
-    report += f"| {total_visits} | {total_users} | {total_views} | {avg_bounce:.0f}% {bounce_flag} | {avg_duration:.0f} сек |\n\n"
+    append(f"| {total_visits} | {total_users} | {total_views} | {avg_bounce:.0f}% {bounce_flag} | {avg_duration:.0f} сек |\n\n")
 
     # По дням
-    report += "## По дням\n\n"
-    report += "| Дата | Визиты | Пользователи | Просмотры | Отказы |\n"
-    report += "|------|--------|-------------|-----------|--------|\n"
-    for r in traffic:
-        report += f"| {r['date']} | {r['visits']} | {r['users']} | {r['pageviews']} | {r['bounce_rate']}% |\n"
+    append("## По дням\n\n")
+    append("| Дата | Визиты | Пользователи | Просмотры | Отказы |\n")
+    append("|------|--------|-------------|-----------|--------|\n")
+    parts.extend(
+        f"| {r['date']} | {r['visits']} | {r['users']} | {r['pageviews']} | {r['bounce_rate']}% |\n"
+        for r in traffic
+    )
 
     # Источники
     if sources:
-        report += "\n## Источники трафика\n\n"
-        report += "| Источник | Визиты | Пользователи | Отказы |\n"
-        report += "|----------|--------|-------------|--------|\n"
-        for r in sorted(sources, key=lambda x: x["visits"], reverse=True):
-            report += f"| {r['source']} | {r['visits']} | {r['users']} | {r['bounce_rate']}% |\n"
+        append("\n## Источники трафика\n\n")
+        append("| Источник | Визиты | Пользователи | Отказы |\n")
+        append("|----------|--------|-------------|--------|\n")
+        parts.extend(
+            f"| {r['source']} | {r['visits']} | {r['users']} | {r['bounce_rate']}% |\n"
+            for r in sorted(sources, key=itemgetter("visits"), reverse=True)
+        )
 
     # Поисковые запросы
     if queries:
-        report += "\n## Поисковые запросы (топ)\n\n"
-        report += "| Запрос | Визиты |\n"
-        report += "|--------|--------|\n"
-        for r in queries[:20]:
-            report += f"| {r['query']} | {r['visits']} |\n"
-
-    report += "\n---\n*Сгенерировано автоматически скриптом yandex_metrica_stats.py*\n"
-    return report
-
-
-def append_to_csv(traffic: list, csv_path: Path):
-    """Добавить данные в кумулятивный CSV"""
+        append("\n## Поисковые запросы (топ)\n\n")
+        append("| Запрос | Визиты |\n")
+        append("|--------|--------|\n")
+        parts.extend(f"| {r['query']} | {r['visits']} |\n" for r in islice(queries, 20))
+
+    append("\n---\n*Сгенерировано автоматически скриптом yandex_metrica_stats.py*\n")
+    return "".join(parts)
+
+
+def load_existing_dates(csv_path: Path) -> set:
+    """Даты, уже записанные в кумулятивный CSV (читаем только колонку «Дата»)"""
+    if not csv_path.exists():
+        return set()
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f, delimiter=";")
+        header = next(reader, None)
+        if not header or "Дата" not in header:
+            return set()
+        col = header.index("Дата")
+        return {row[col] for row in reader if len(row) > col}
+
+
+def report_covers(md_path: Path, date_from: str, date_to: str) -> bool:
+    """MD-отчёт уже есть и построен ровно за период date_from — date_to"""
+    if not md_path.exists():
+        return False
+    with open(md_path, "r", encoding="utf-8") as f:
+        head = "".join(islice(f, 4))
+    return f"**Период:** {date_from} — {date_to}\n" in head
+
+
+def append_to_csv(traffic: list, csv_path: Path, existing_dates: set = None):
+    """Добавить данные в кумулятивный CSV (existing_dates — если уже прочитаны)"""
     file_exists = csv_path.exists()
     fieldnames = ["Дата", "Визиты", "Пользователи", "Просмотры", "Отказы %", "Ср. время (сек)"]
 
-    existing_dates = set()
-    if file_exists:
-        with open(csv_path, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f, delimiter=";")
-            for row in reader:
-                existing_dates.add(row.get("Дата", ""))
+    if existing_dates is None:
+        existing_dates = load_existing_dates(csv_path)
 
-    new_rows = []
-    for r in traffic:
-        if r["date"] not in existing_dates:
-            new_rows.append({
-                "Дата": r["date"],
-                "Визиты": r["visits"],
-                "Пользователи": r["users"],
-                "Просмотры": r["pageviews"],
-                "Отказы %": r["bounce_rate"],
-                "Ср. время (сек)": r["avg_duration"],
-            })
+    new_rows = [
+        (r["date"], r["visits"], r["users"], r["pageviews"], r["bounce_rate"], r["avg_duration"])
+        for r in traffic
+        if r["date"] not in existing_dates
+    ]
 
     if not new_rows:
         print("   CSV: нет новых данных")
         return
 
     with open(csv_path, "a", encoding="utf-8", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter=";")
+        writer = csv.writer(f, delimiter=";")
         if not file_exists:
-            writer.writeheader()
+            writer.writerow(fieldnames)
         writer.writerows(new_rows)
     print(f"   CSV: +{len(new_rows)} строк → {csv_path.name}")
 
@@ -200,6 +251,8 @@ def main():
     parser = argparse.ArgumentParser(description="Сбор статистики Яндекс.Метрики")
     parser.add_argument("--business", required=True)
     parser.add_argument("--days", type=int, default=1, help="За сколько дней (по умолчанию 1)")
+    parser.add_argument("--only-missing", action="store_true",
+                        help="Запрашивать только дни, которых ещё нет в metrica.csv")
     args = parser.parse_args()
 
     creds = load_credentials(args.business)
@@ -215,30 +268,47 @@ def main():
         print(f"   ID счётчика можно найти на metrika.yandex.ru")
         sys.exit(1)
 
-    date_to = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-    date_from = (datetime.now() - timedelta(days=args.days)).strftime("%Y-%m-%d")
+    now = datetime.now()
+    date_to = (now - timedelta(days=1)).strftime("%Y-%m-%d")
+    date_from = (now - timedelta(days=args.days)).strftime("%Y-%m-%d")
+
+    # Папка отчётов (общая для сайта, не для проекта)
+    reports_dir = BUSINESSES_DIR / args.business / "projects" / "yandex-direct" / "reports"
+    csv_path = reports_dir / "metrica.csv"
+    md_path = reports_dir / f"metrica_{date_from}.md"
+
+    # Все запрошенные дни уже в CSV и отчёт ровно за этот период уже есть — в API не ходим.
+    # Имя файла содержит только date_from, поэтому сверяем строку «Период» внутри отчёта:
+    # дневной отчёт за тот же date_from недельный не заменяет
+    existing_dates = load_existing_dates(csv_path)
+    requested = {(now - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(1, args.days + 1)}
+    missing = requested - existing_dates
+    if not missing and report_covers(md_path, date_from, date_to):
+        print(f"✅ Метрика {args.business} за {date_from} — {date_to}: уже в metrica.csv и {md_path.name}")
+        return
+    if missing and args.only_missing:
+        date_from, date_to = min(missing), max(missing)
+        md_path = reports_dir / f"metrica_{date_from}.md"
 
     print(f"📊 Метрика {args.business} за {date_from} — {date_to}...")
 
     try:
-        traffic = get_traffic_summary(token, counter_id, date_from, date_to)
-        sources = get_traffic_sources(token, counter_id, date_from, date_to)
-        queries = get_search_queries(token, counter_id, date_from, date_to)
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            # Три независимых запроса к API — параллельно, ждём самый долгий, а не сумму
+            traffic_future = pool.submit(get_traffic_summary, token, counter_id, date_from, date_to)
+            sources_future = pool.submit(get_traffic_sources, token, counter_id, date_from, date_to)
+            queries_future = pool.submit(get_search_queries, token, counter_id, date_from, date_to)
+            traffic = traffic_future.result()
+            sources = sources_future.result()
+            queries = queries_future.result()
         print(f"   Дней с данными: {len(traffic)}")
 
-        # Папка отчётов (общая для сайта, не для проекта)
-        reports_dir = BUSINESSES_DIR / args.business / "projects" / "yandex-direct" / "reports"
         reports_dir.mkdir(parents=True, exist_ok=True)
-
-        # MD-отчёт
         report_md = generate_report_md(traffic, sources, queries, date_from, date_to, args.business)
-        md_path = reports_dir / f"metrica_{date_from}.md"
-        md_path.write_text(report_md)
-        print(f"✅ MD-отчёт: {md_path.name}")
 
-        # Кумулятивный CSV
-        csv_path = reports_dir / "metrica.csv"
-        append_to_csv(traffic, csv_path)
+        md_path.write_bytes(report_md.encode("utf-8"))
+        print(f"✅ MD-отчёт: {md_path.name}")
+        append_to_csv(traffic, csv_path, existing_dates)
         print(f"✅ CSV: metrica.csv")
 
         print("\n" + report_md)